@@ -1,100 +1,362 @@
 #!/usr/bin/env python3
 """
 Backend API для NFT минта с x402
-УЛУЧШЕННАЯ ВЕРСИЯ v2 - с защитой от nonce conflicts и retry логикой
+УЛУЧШЕННАЯ ВЕРСИЯ v3 - ASGI (Quart) + AsyncWeb3, с защитой от nonce conflicts и retry логикой
+
+Запуск: hypercorn backend:app --bind 0.0.0.0:$PORT --worker-class uvloop (см. Procfile)
+Один воркер: event loop и так держит сотни mint запросов в ожидании RPC,
+а NonceManager живет в процессе - несколько воркеров делили бы один admin nonce
 """
 
-from flask import Flask, request, jsonify, Response, render_template
-from web3 import Web3
+from quart import Quart, request, jsonify, Response, render_template
+from quart.json.provider import JSONProvider
+from web3 import Web3, AsyncWeb3, AsyncHTTPProvider
+from web3.exceptions import TimeExhausted
+from web3.datastructures import AttributeDict
+from eth_abi import encode as abi_encode, decode as abi_decode
+from eth_account import Account
+from eth_account.messages import SignableMessage
+from eth_hash.auto import keccak as _keccak
 from dotenv import load_dotenv
+from cachetools import TTLCache, TLRUCache
+import aiohttp
+import orjson
+import asyncio
+import functools
+import hashlib
 import os
 import json
-import base64
+import binascii
+import logging
+import logging.handlers
+import atexit
+import queue
 import sys
-import traceback
 import time
-import threading
 
 # Загружаем переменные из .env файла
 load_dotenv()
 
-app = Flask(__name__)
+class ORJSONProvider(JSONProvider):
+    """jsonify через orjson: без сортировки ключей и stdlib json encode на каждый ответ"""
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        # Bytes сразу в Response, без промежуточной str
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(orjson.dumps(obj), mimetype="application/json")
+
+app = Quart(__name__)
+app.json = ORJSONProvider(app)
+# Тело запроса нужно только для {"payment": ...} (~1KB) - большие тела отсекает Quart (413) до парсинга
+app.config['MAX_CONTENT_LENGTH'] = 16 * 1024
 
 # ═══════════════════════════════════════════════════════════
 # НАСТРОЙКИ - ЗАПОЛНИ ИХ!
 # ═══════════════════════════════════════════════════════════
 
-BASE_RPC = "https://rpc.ankr.com/base/13ca64398a6a0125df8e188d1525542811320f016be33834bba2f4f32be7c4c8"  # Ankr RPC с API ключом
+BASE_RPC = os.getenv("BASE_RPC", "https://mainnet.base.org")  # RPC Base, можно несколько через запятую (failover)
 NFT_CONTRACT = os.getenv("NFT_CONTRACT", "0x...")  # Адрес твоего NFT контракта
 ADMIN_PRIVATE_KEY = os.getenv("ADMIN_KEY")  # Приватный ключ для минта NFT
 MINT_PRICE = int(os.getenv("MINT_PRICE", "1000000"))  # Цена в USDC (1000000 = 1 USDC)
 RECIPIENT_ADDRESS = os.getenv("RECIPIENT_ADDRESS")  # Адрес получателя USDC (твой адрес)
 
-w3 = Web3(Web3.HTTPProvider(BASE_RPC))
+class FailoverHTTPProvider(AsyncHTTPProvider):
+    """AsyncHTTPProvider со списком RPC: при сетевой ошибке переключается на следующий"""
+
+    def __init__(self, endpoint_uris, **kwargs):
+        super().__init__(endpoint_uris[0], **kwargs)
+        self.endpoint_uris = endpoint_uris
+
+    def _failover(self, failed_uri):
+        # Переключаем только если параллельный запрос еще не переключил
+        if self.endpoint_uri == failed_uri:
+            i = self.endpoint_uris.index(failed_uri)
+            self.endpoint_uri = self.endpoint_uris[(i + 1) % len(self.endpoint_uris)]
+            logger.warning("🔀 RPC %s недоступен, переключаемся на %s", failed_uri, self.endpoint_uri)
+
+    async def _with_failover(self, call):
+        for attempt in range(len(self.endpoint_uris)):
+            uri = self.endpoint_uri
+            try:
+                return await call()
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                if attempt >= len(self.endpoint_uris) - 1:
+                    raise
+                self._failover(uri)
+
+    async def make_request(self, method, params):
+        return await self._with_failover(lambda: super(FailoverHTTPProvider, self).make_request(method, params))
+
+    async def make_batch_request(self, batch_requests):
+        return await self._with_failover(lambda: super(FailoverHTTPProvider, self).make_batch_request(batch_requests))
+
+    async def cache_async_session(self, session):
+        """Один keep-alive session на все endpoint'ы (web3 кэширует session по URI)"""
+        for uri in self.endpoint_uris:
+            await self._request_session_manager.async_cache_and_return_session(uri, session)
+        return session
+
+# Таймаут на RPC запрос: зависший endpoint не держит минт 30с (дефолт web3), а быстрее уходит в failover
+RPC_TIMEOUT = aiohttp.ClientTimeout(total=10)
+
+w3 = AsyncWeb3(FailoverHTTPProvider(
+    [u.strip() for u in BASE_RPC.split(',') if u.strip()],
+    request_kwargs={'timeout': RPC_TIMEOUT},
+    # Без встроенных retry web3 (5 повторов с backoff внутри make_request): иначе до
+    # failover проходит ~5 таймаутов. Повторы - только переключение endpoint'а
+    exception_retry_configuration=None
+))
+# Газ, fees, chainId и адреса (checksum, не ENS) задаем сами, tx подписываем локально,
+# receipt разбираем сами (parse_receipt) - default middleware web3 здесь только оборачивают каждый RPC
+for _name in ('gas_price_strategy', 'ens_name_to_address', 'attrdict', 'validation', 'gas_estimate'):
+    w3.middleware_onion.remove(_name)
 
 # Кэш для /api/info (чтобы не тормозить загрузку)
-info_cache = {"data": None, "timestamp": 0}
+info_cache = {"data": None, "timestamp": 0, "body": None, "etag": None}
 CACHE_TTL = 10  # Кэш на 10 секунд
+info_refresh_task = None  # фоновое обновление info_cache (одно на всех)
 
-# Lock для facilitator (предотвращает nonce conflicts)
-facilitator_lock = threading.Lock()
-mint_lock = threading.Lock()
-
-# Функция для логирования с flush
-def log(message):
-    print(message)
-    sys.stdout.flush()
-
-# ABI для NFT контракта (STUPID402NFT)
-NFT_ABI = [
-    {
-        "inputs": [
-            {"name": "to", "type": "address"},
-            {"name": "txHash", "type": "bytes32"}
-        ],
-        "name": "mintNFT",
-        "outputs": [],
-        "stateMutability": "nonpayable",
-        "type": "function"
-    },
-    {
-        "inputs": [],
-        "name": "currentTokenId",
-        "outputs": [{"name": "", "type": "uint256"}],
-        "stateMutability": "view",
-        "type": "function"
-    },
-    {
-        "inputs": [],
-        "name": "MAX_SUPPLY",
-        "outputs": [{"name": "", "type": "uint256"}],
-        "stateMutability": "view",
-        "type": "function"
-    },
-    {
-        "inputs": [],
-        "name": "totalSupply",
-        "outputs": [{"name": "", "type": "uint256"}],
-        "stateMutability": "view",
-        "type": "function"
-    }
-]
+# MAX_SUPPLY неизменяем - после первого успешного чтения больше не запрашиваем
+max_supply_cache = None
+
+# EIP-3009 авторизации (from, nonce), которые уже в работе: повторный x-payment
+# не должен второй раз отправлять transferWithAuthorization (гарантированный revert).
+# Значение - (validBefore, состояние): отметка живет до validBefore, после него USDC
+# авторизацию не примет и без нас (timer=time.time - ttu отдает validBefore как есть)
+_seen_authorizations = TLRUCache(maxsize=10_000, ttu=lambda key, value, now: value[0], timer=time.time)
+
+# Результаты decode/проверки подписи для повторов одного и того же x-payment
+# (retry клиента, пинги x402scan). Ключ - весь header / все подписанные поля,
+# не nonce: подделка с чужим nonce не должна попасть на чужой результат.
+# Lock не нужен - между get и set нет await
+_decoded_payments = TTLCache(maxsize=4096, ttl=300)
+_verified_signatures = TTLCache(maxsize=4096, ttl=300)
+
+# Фоновые задачи минтов: id задания (payment txHash) -> asyncio.Task с итогом
+# (TTLCache держит ссылку на задачу и сам чистит старые)
+pending_mints = TTLCache(maxsize=10_000, ttl=3600)
+
+# Сколько заданий минта может одновременно висеть незавершенными.
+# Mempool держит ограниченное число pending tx на аккаунт (geth: 16) - сверх
+# лимита tx отбрасываются и мы платим RTT за заведомо проваленные отправки.
+# У задания в mempool не больше одного tx (сначала USDC transfer, потом минт),
+# остаток до 16 - запас под facilitate и cancel
+MAX_PENDING_MINTS = int(os.getenv("MAX_PENDING_MINTS", "12"))
+mint_slots = asyncio.Semaphore(MAX_PENDING_MINTS)
+
+# Логирование через logging: форматирование ленивое (%s), строка собирается
+# только если уровень включен. Уровень - через LOG_LEVEL.
+# Запись в stdout - в отдельном потоке (QueueListener), event loop только кладет record в очередь
+logger = logging.getLogger('stupid402')
+logger.setLevel(os.getenv('LOG_LEVEL', 'INFO').upper())
+_log_queue = queue.SimpleQueue()
+_log_handler = logging.StreamHandler(sys.stdout)
+_log_handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(message)s'))
+_log_listener = logging.handlers.QueueListener(_log_queue, _log_handler)
+_log_listener.start()
+atexit.register(_log_listener.stop)
+logger.addHandler(logging.handlers.QueueHandler(_log_queue))
+logger.propagate = False
+
+# ═══════════════════════════════════════════════════════════
+# КЭШ АККАУНТА, АДРЕСОВ И КОНТРАКТОВ (считаем один раз при старте)
+# ═══════════════════════════════════════════════════════════
+
+USDC_ADDRESS = "0x833589fcd6edb6e08f4c7c32d4f71b54bda02913"  # USDC на Base
+MULTICALL3_ADDRESS = "0xcA11bde05977b3631167028862bE2a173976CA11"  # Multicall3 (тот же адрес во всех сетях)
+
+# Деривация ключа (secp256k1) и checksum (keccak) - не на каждый запрос
+ADMIN = w3.eth.account.from_key(ADMIN_PRIVATE_KEY) if ADMIN_PRIVATE_KEY else None
+USDC_CS = Web3.to_checksum_address(USDC_ADDRESS)
+NFT_CS = Web3.to_checksum_address(NFT_CONTRACT) if Web3.is_address(NFT_CONTRACT) else None
+RECIPIENT_CS = Web3.to_checksum_address(RECIPIENT_ADDRESS) if RECIPIENT_ADDRESS else None
+RECIPIENT_BYTES = bytes.fromhex(RECIPIENT_CS[2:]) if RECIPIENT_CS else None
+
+# Checksum адресов из платежей: один и тот же payer приходит много раз (retry, повторные минты)
+_checksum = functools.lru_cache(maxsize=4096)(Web3.to_checksum_address)
+
+# Calldata для /api/info не меняется - собираем один раз, без ABI/contract машинерии web3:
+# view-функции без аргументов - это просто 4-байтовый селектор
+TOTAL_SUPPLY_DATA = _keccak(b"totalSupply()")[:4]
+MAX_SUPPLY_DATA = _keccak(b"MAX_SUPPLY()")[:4]
+AGGREGATE3_SELECTOR = _keccak(b"aggregate3((address,bool,bytes)[])")[:4]
+INFO_MULTICALL_DATA = AGGREGATE3_SELECTOR + abi_encode(['(address,bool,bytes)[]'], [[
+    (NFT_CS, False, TOTAL_SUPPLY_DATA),
+    (NFT_CS, False, MAX_SUPPLY_DATA)
+]]) if NFT_CS else None
+
+# EIP-712 домен USDC на Base (EIP-3009) - domain separator считаем один раз
+EIP712_DOMAIN_SEPARATOR = Web3.keccak(abi_encode(
+    ['bytes32', 'bytes32', 'bytes32', 'uint256', 'address'],
+    [
+        Web3.keccak(text="EIP712Domain(string name,string version,uint256 chainId,address verifyingContract)"),
+        Web3.keccak(text="USD Coin"),
+        Web3.keccak(text="2"),
+        8453,
+        USDC_CS
+    ]
+))
+TRANSFER_WITH_AUTHORIZATION_TYPEHASH = Web3.keccak(
+    text="TransferWithAuthorization(address from,address to,uint256 value,uint256 validAfter,uint256 validBefore,bytes32 nonce)"
+)
+
+# Calldata admin tx собираем руками: selector (константа) + eth_abi.encode,
+# без поиска функции по ABI и валидации аргументов ContractFunction на каждый tx
+TRANSFER_WITH_AUTHORIZATION_SELECTOR = _keccak(
+    b"transferWithAuthorization(address,address,uint256,uint256,uint256,bytes32,uint8,bytes32,bytes32)"
+)[:4]
+TRANSFER_WITH_AUTHORIZATION_TYPES = ['address', 'address', 'uint256', 'uint256', 'uint256', 'bytes32', 'uint8', 'bytes32', 'bytes32']
+MINT_NFT_SELECTOR = _keccak(b"mintNFT(address,bytes32)")[:4]
+MINT_NFT_TYPES = ['address', 'bytes32']
+# ERC-721 Transfer(from, to, tokenId): минт = Transfer от нулевого адреса, tokenId берем из receipt
+TRANSFER_EVENT_TOPIC = _keccak(b"Transfer(address,address,uint256)")
+ZERO_TOPIC = bytes(32)
+
+# ═══════════════════════════════════════════════════════════
+# 402 ОТВЕТ (все поля - константы модуля, сериализуем один раз)
+# ═══════════════════════════════════════════════════════════
+
+_ACCEPTS_RESPONSE_BYTES = orjson.dumps({
+    "error": "Payment required to access this resource",
+    "x402Version": 1,
+    "facilitator": "https://stupidx402.onrender.com/api/facilitate",
+    "accepts": [{
+        "scheme": "exact",
+        "network": "base",
+        "asset": USDC_CS,
+        "maxAmountRequired": str(MINT_PRICE),
+        "payTo": RECIPIENT_ADDRESS,
+        "resource": "https://stupidx402.onrender.com/api/mint",
+        "description": "Mint 1 STUPID402 NFT.",
+        "mimeType": "application/json",
+        "maxTimeoutSeconds": 300,
+        "outputSchema": {
+            "input": {
+                "type": "http",
+                "method": "GET",
+                "discoverable": True
+            },
+            "output": {
+                "type": "object",
+                "properties": {
+                    "success": {"type": "boolean"},
+                    "job": {"type": "string"},
+                    "tx": {"type": "string"},
+                    "to": {"type": "string"},
+                    "tokenId": {"type": "number"}
+                }
+            }
+        },
+        "extra": {
+            "recipientAddress": RECIPIENT_ADDRESS,
+            "name": "USD Coin",
+            "version": "2",
+            "primaryType": "TransferWithAuthorization",
+            "projectName": "STUPID402",
+            "projectDescription": "STUPID402 NFT Collection on Base",
+            "website": "https://stupidx402.onrender.com",
+            "icon": "https://stupidx402.onrender.com/static/icon.png"
+        }
+    }]
+})
+# Тело неизменно до рестарта: ETag и кэширование discovery-ответа для x402scan/CDN.
+# Vary: без x-payment и с ним - разные ответы, кэш не должен их смешивать
+_ACCEPTS_RESPONSE_HEADERS = (
+    ('ETag', '"%s"' % hashlib.blake2b(_ACCEPTS_RESPONSE_BYTES, digest_size=16).hexdigest()),
+    ('Cache-Control', 'public, max-age=60'),
+    ('Vary', 'X-PAYMENT'),
+)
+
+# ═══════════════════════════════════════════════════════════
+# NONCE MANAGER
+# ═══════════════════════════════════════════════════════════
+
+class NonceManager:
+    """
+    Локальный счетчик nonce для admin аккаунта.
+    Admin - единственный подписант, поэтому nonce берем из chain один раз,
+    дальше просто инкрементируем. При ошибке - resync из chain.
+    """
+
+    def __init__(self, address):
+        self.address = address
+        self._nonce = None
+        self._lock = asyncio.Lock()
+
+    async def _sync(self):
+        self._nonce = await w3.eth.get_transaction_count(self.address, 'pending')
+        logger.info("🔢 NonceManager: синхронизирован с chain, nonce=%s", self._nonce)
+
+    async def warm_up(self):
+        """Синхронизация при старте, чтобы первый минт не ждал get_transaction_count"""
+        async with self._lock:
+            if self._nonce is None:
+                await self._sync()
+
+    async def next(self, count=1):
+        """
+        Резервирует count nonce подряд и возвращает первый (при первом вызове -
+        синхронизация с chain). После возврата вызывающий продолжает без yield,
+        поэтому зарезервировавший раньше и в очередь встанет раньше.
+        """
+        async with self._lock:
+            if self._nonce is None:
+                await self._sync()
+            nonce = self._nonce
+            self._nonce += count
+            return nonce
+
+    def reset(self):
+        """Сбрасывает счетчик - следующий next() заново прочитает pending nonce"""
+        self._nonce = None
+
+nonce_mgr = NonceManager(ADMIN.address) if ADMIN else None
 
 # ═══════════════════════════════════════════════════════════
 # X402 ФУНКЦИИ
 # ═══════════════════════════════════════════════════════════
 
+# base64.b64decode без altchars/validate - обертка над этим же C вызовом
+_b64d = binascii.a2b_base64
+
+MAX_X_PAYMENT_SIZE = 8192
+# Одна подпись в hex - 132 символа, а x-payment - это base64 JSON с подписью, адресами
+# и nonce: короче подписи реального x-payment не бывает
+MIN_X_PAYMENT_SIZE = 132
+
 def decode_x402_payment(x_payment_header):
     """Декодирует x-payment header из x402"""
+    cached = _decoded_payments.get(x_payment_header)
+    if cached is not None:
+        return cached
+    
+    # Настоящий x-payment - ~1KB; мусор на публичном endpoint не декодируем
+    if x_payment_header and len(x_payment_header) > MAX_X_PAYMENT_SIZE:
+        logger.error("❌ x-payment слишком большой: %s байт", len(x_payment_header))
+        return {'valid': False, 'error': 'x-payment too large'}
+    if x_payment_header and len(x_payment_header) < MIN_X_PAYMENT_SIZE:
+        logger.error("❌ x-payment слишком короткий: %s байт", len(x_payment_header))
+        return {'valid': False, 'error': 'x-payment too short'}
+    
     try:
         # Проверка на пустой x-payment
         if not x_payment_header:
-            log(f"❌ x-payment пустой")
+            logger.error("❌ x-payment пустой")
             return {'valid': False, 'error': 'Empty x-payment'}
         
-        # Декодируем base64
-        decoded = base64.b64decode(x_payment_header)
-        payment_data = json.loads(decoded.decode('utf-8'))
+        # Декодируем base64 (orjson парсит bytes напрямую)
+        decoded = _b64d(x_payment_header)
+        try:
+            payment_data = orjson.loads(decoded)
+        except orjson.JSONDecodeError:
+            # Fallback: stdlib json принимает то, что orjson не умеет (int > 64 бит)
+            payment_data = json.loads(decoded)
         
         # x402scan использует новую структуру с вложенными полями
         # Проверяем, есть ли payload.authorization (новый формат)
@@ -121,266 +383,790 @@ def decode_x402_payment(x_payment_header):
         
         # Проверяем обязательные поля
         if not all([from_addr, to_addr, value, nonce, valid_after, valid_before, signature]):
-            log(f"❌ Отсутствуют обязательные поля")
+            logger.error("❌ Отсутствуют обязательные поля")
             return {'valid': False, 'error': 'Missing required fields'}
         
-        log(f"✅ Платеж декодирован: from={from_addr}, to={to_addr}, value={value}")
+        # Адреса, nonce и подпись - hex строки (дальше по ним .lower()/bytes.fromhex)
+        if not all(isinstance(f, str) for f in (from_addr, to_addr, nonce, signature)):
+            logger.error("❌ Поля платежа не строки")
+            return {'valid': False, 'error': 'Invalid field types'}
+        
+        logger.info("✅ Платеж декодирован: from=%s, to=%s, value=%s", from_addr, to_addr, value)
         
-        # Генерируем уникальный txHash для этой транзакции
-        tx_hash = Web3.keccak(text=f"{from_addr}{nonce}{valid_before}").hex()
-        log(f"🔐 Сгенерирован txHash: {tx_hash}")
+        # Адреса, nonce и (v, r, s) в bytes один раз: нужны для txHash, проверки подписи и calldata.
+        # eth_abi кодирует address из 20 байт без checksum (keccak) на каждый вызов
+        from_bytes = bytes.fromhex(from_addr.removeprefix('0x'))
+        to_bytes = bytes.fromhex(to_addr.removeprefix('0x'))
+        if len(from_bytes) != 20 or len(to_bytes) != 20:
+            logger.error("❌ Неверная длина адреса")
+            return {'valid': False, 'error': 'Invalid address'}
+        # bytes32 nonce - ровно 32 байта: короткий eth_abi дополнил бы нулями, и та же
+        # авторизация дала бы другой txHash (обход дедупликации mintNFT) и другой ключ replay
+        nonce_bytes = bytes.fromhex(nonce.removeprefix('0x'))
+        if len(nonce_bytes) != 32:
+            logger.error("❌ Неверная длина nonce: %s байт", len(nonce_bytes))
+            return {'valid': False, 'error': 'Invalid nonce'}
+        vrs = split_signature(signature)
         
-        return {
+        # Генерируем уникальный txHash для этой транзакции: keccak от packed bytes
+        # (from 20 + nonce 32 + validBefore 32), как abi.encodePacked - регистр адреса не влияет
+        tx_hash_bytes = _keccak(
+            from_bytes
+            + nonce_bytes
+            + int(valid_before).to_bytes(32, 'big')
+        )
+        tx_hash = tx_hash_bytes.hex()
+        logger.info("🔐 Сгенерирован txHash: %s", tx_hash)
+        
+        _decoded_payments[x_payment_header] = payment = {
             'valid': True,
             'from': from_addr,
             'to': to_addr,
+            'fromBytes': from_bytes,
+            'toBytes': to_bytes,
             'value': value,
             'nonce': nonce,
+            'nonceBytes': nonce_bytes,
             'validAfter': valid_after,
             'validBefore': valid_before,
             'signature': signature,
-            'txHash': tx_hash
+            'vrs': vrs,
+            'txHash': tx_hash,
+            'txHashBytes': tx_hash_bytes
         }
+        return payment
     except Exception as e:
-        log(f"❌ Ошибка декодирования x-payment: {e}")
-        log(f"📜 Traceback: {traceback.format_exc()}")
+        # Кривой x-payment от клиента - не наша ошибка, traceback только на DEBUG
+        logger.error("❌ Ошибка декодирования x-payment: %s", e)
+        logger.debug("📜 Traceback:", exc_info=True)
         return {'valid': False, 'error': str(e)}
 
 # ═══════════════════════════════════════════════════════════
-# API ENDPOINTS
+# ТРАНЗАКЦИИ ОТ ADMIN
 # ═══════════════════════════════════════════════════════════
 
-@app.route('/')
-def index():
-    """Главная страница"""
-    return render_template('index.html')
+# Неизменная часть каждой admin транзакции (EIP-1559, Base mainnet)
+TX_TEMPLATE = {
+    'type': 2,
+    'chainId': 8453,
+    'value': 0,
+    'maxPriorityFeePerGas': Web3.to_wei('0.01', 'gwei'),  # Увеличили с 0.001 до 0.01
+}
 
-@app.route('/api/facilitate', methods=['POST', 'OPTIONS'])
-def facilitate():
+# EIP-1559 fees: фоновая задача обновляет оценку раз в GAS_REFRESH_INTERVAL
+# через eth_feeHistory, и send_admin_tx не ходит в RPC за gas_price на каждый tx
+GAS_REFRESH_INTERVAL = 10
+
+# Опрос receipt: блок на Base ~2с, дефолтные 0.1с web3 - это ~20 лишних RPC на tx.
+# Первый опрос через 0.25с (tx часто попадает уже в следующий блок), дальше x1.5 до времени блока
+RECEIPT_POLL_LATENCY = 0.25
+RECEIPT_POLL_MAX = 2.0
+RECEIPT_BATCH_SIZE = 50  # Сколько eth_getTransactionReceipt максимум в одном JSON-RPC batch
+_gas_cache = {'ts': 0, 'base_fee': 0, 'max_prio': TX_TEMPLATE['maxPriorityFeePerGas']}
+
+async def refresh_gas_cache():
+    """Обновляет base fee следующего блока и priority fee (медиана последнего блока)"""
+    history = await w3.eth.fee_history(1, 'latest', [50])
+    _gas_cache['base_fee'] = history['baseFeePerGas'][-1]
+    _gas_cache['max_prio'] = max(history['reward'][0][0], TX_TEMPLATE['maxPriorityFeePerGas'])
+    _gas_cache['ts'] = time.time()
+
+async def gas_refresh_loop():
+    """Фоновое обновление _gas_cache"""
+    while True:
+        try:
+            await refresh_gas_cache()
+        except Exception as e:
+            logger.warning("⚠️ Не удалось обновить fee history: %s", e)
+        await asyncio.sleep(GAS_REFRESH_INTERVAL)
+
+async def current_fees():
+    """(base_fee, max_prio) из кэша; если кэш пуст или протух - читаем fee history сразу"""
+    if time.time() - _gas_cache['ts'] > GAS_REFRESH_INTERVAL * 3:
+        await refresh_gas_cache()
+    return _gas_cache['base_fee'], _gas_cache['max_prio']
+
+# Receipt всех ожидающих tx опрашивает один фоновый poller: на каждом тике - один
+# JSON-RPC batch на все tx, которым подошел срок (пара USDC + mint, параллельные минты).
+# tx_hash -> [future, срок следующего опроса (monotonic), текущий интервал]
+_receipt_waiters = {}
+_receipt_wakeup = asyncio.Event()
+receipt_poller_task = None
+
+def parse_receipt(response):
     """
-    Facilitator endpoint - выполняет USDC transfer используя подпись пользователя
-    УЛУЧШЕННАЯ ВЕРСИЯ с Lock и retry логикой
+    Receipt из сырого JSON-RPC ответа (None - tx еще не в блоке). Разбираем только то,
+    что читаем сами (status, gasUsed, логи) - без приватных форматтеров web3._utils
     """
-    if request.method == 'OPTIONS':
-        return '', 204
+    if response.get('error'):
+        raise ValueError(response['error'])
+    raw = response.get('result')
+    if not raw:
+        return None
+    return AttributeDict.recursive({
+        'transactionHash': bytes.fromhex(raw['transactionHash'][2:]),
+        'blockNumber': int(raw['blockNumber'], 16),
+        'status': int(raw['status'], 16),
+        'gasUsed': int(raw['gasUsed'], 16),
+        'logs': [
+            {'address': log['address'], 'topics': [bytes.fromhex(topic[2:]) for topic in log['topics']]}
+            for log in raw['logs']
+        ]
+    })
+
+async def fetch_receipts(tx_hashes):
+    """Receipt по списку hash (None - еще не в блоке); несколько hash - одним batch"""
+    # Запросы идут через провайдер напрямую: web3 batch_requests бросает TransactionNotFound
+    # на весь batch, если нет хотя бы одного receipt
+    if len(tx_hashes) == 1:
+        return [parse_receipt(await w3.provider.make_request('eth_getTransactionReceipt', [Web3.to_hex(tx_hashes[0])]))]
     
-    # Используем Lock чтобы только 1 facilitate за раз
-    with facilitator_lock:
+    responses = await w3.provider.make_batch_request([
+        ('eth_getTransactionReceipt', [Web3.to_hex(tx_hash)]) for tx_hash in tx_hashes
+    ])
+    if not isinstance(responses, list):
+        raise ValueError(responses.get('error'))
+    
+    # Ответы batch могут прийти в любом порядке - сопоставляем по id
+    return [parse_receipt(response) for response in sorted(responses, key=lambda r: r['id'])]
+
+async def receipt_poller():
+    """Фоновый опрос receipt для всех wait_for_receipt; завершается, когда ждать некого"""
+    while _receipt_waiters:
+        now = time.monotonic()
+        due_at = min(waiter[1] for waiter in _receipt_waiters.values())
+        if due_at > now:
+            # Спим до ближайшего срока, новый tx будит раньше
+            _receipt_wakeup.clear()
+            try:
+                await asyncio.wait_for(_receipt_wakeup.wait(), due_at - now)
+            except asyncio.TimeoutError:
+                pass
+            continue
+        
+        due = [tx_hash for tx_hash, waiter in _receipt_waiters.items() if waiter[1] <= now][:RECEIPT_BATCH_SIZE]
         try:
-            x_payment = request.headers.get('x-payment')
-            if not x_payment and request.is_json:
-                try:
-                    x_payment = request.json.get('payment')
-                except:
-                    pass
-            
-            if not x_payment:
-                return jsonify({"error": "Missing x-payment"}), 400
-            
-            log("🔧 Facilitator: начинаем USDC transfer...")
+            found = dict(zip(due, await fetch_receipts(due)))
+        except Exception as e:
+            logger.warning("⚠️ Опрос receipt (%s TX) не прошел: %s", len(due), e)
+            found = {}
+        
+        now = time.monotonic()
+        for tx_hash in due:
+            waiter = _receipt_waiters.get(tx_hash)
+            if waiter is None:
+                continue
+            receipt = found.get(tx_hash)
+            if receipt is not None:
+                del _receipt_waiters[tx_hash]
+                if not waiter[0].done():
+                    waiter[0].set_result(receipt)
+            else:
+                # Backoff на каждый tx отдельно: 0.25с -> x1.5 -> 2с
+                waiter[2] = min(waiter[2] * 1.5, RECEIPT_POLL_MAX)
+                waiter[1] = now + waiter[2]
+
+async def wait_for_receipt(tx_hash, timeout):
+    """Ждет receipt через общий poller (см. receipt_poller)"""
+    global receipt_poller_task
+    waiter = _receipt_waiters.get(tx_hash)
+    if waiter is None:
+        waiter = _receipt_waiters[tx_hash] = [
+            asyncio.get_running_loop().create_future(),
+            time.monotonic() + RECEIPT_POLL_LATENCY,
+            RECEIPT_POLL_LATENCY
+        ]
+        if receipt_poller_task is None or receipt_poller_task.done():
+            receipt_poller_task = asyncio.create_task(receipt_poller())
+        else:
+            _receipt_wakeup.set()
+    try:
+        # shield: таймаут одного ожидающего не отменяет общий future
+        return await asyncio.wait_for(asyncio.shield(waiter[0]), timeout)
+    except asyncio.TimeoutError:
+        if _receipt_waiters.get(tx_hash) is waiter:
+            del _receipt_waiters[tx_hash]
+        raise TimeExhausted(f"Transaction {tx_hash.hex()} is not in the chain after {timeout} seconds") from None
+
+def split_signature(signature):
+    """Разбирает 65-байтовую подпись на (v, r, s)"""
+    # Один hex-парсинг подписи в 65 байт, r/s уже готовые bytes32
+    sig_bytes = bytes.fromhex(signature.removeprefix('0x'))
+    if len(sig_bytes) != 65:
+        raise ValueError(f"Invalid signature length: {len(sig_bytes)}")
+    return sig_bytes[64], sig_bytes[:32], sig_bytes[32:64]
+
+def verify_payment_signature(payment_data):
+    """
+    Восстанавливает подписанта EIP-3009 авторизации локально (без RPC) и
+    сверяет с payment['from']. Поддельная подпись не должна стоить нам газа.
+    Результат кэшируется по всем подписанным полям.
+    """
+    key = tuple(payment_data[f] for f in ('from', 'to', 'value', 'validAfter', 'validBefore', 'nonce', 'signature'))
+    try:
+        cached = _verified_signatures.get(key)
+    except TypeError:
+        # Нехэшируемые поля (список вместо строки) - без кэша, проверка их отвергнет
+        return _recover_and_check(payment_data)
+    if cached is not None:
+        return cached
+    _verified_signatures[key] = result = _recover_and_check(payment_data)
+    return result
+
+def _recover_and_check(payment_data):
+    """ecrecover EIP-712 подписи и сравнение с from"""
+    try:
+        struct_hash = Web3.keccak(abi_encode(
+            ['bytes32', 'address', 'address', 'uint256', 'uint256', 'uint256', 'bytes32'],
+            [
+                TRANSFER_WITH_AUTHORIZATION_TYPEHASH,
+                payment_data['fromBytes'],
+                payment_data['toBytes'],
+                int(payment_data['value']),
+                int(payment_data['validAfter']),
+                int(payment_data['validBefore']),
+                payment_data['nonceBytes']
+            ]
+        ))
+        message = SignableMessage(
+            version=b'\x01',
+            header=EIP712_DOMAIN_SEPARATOR,
+            body=struct_hash
+        )
+        recovered = Account.recover_message(message, vrs=payment_data['vrs'])
+    except Exception as e:
+        logger.error("❌ Не удалось проверить подпись: %s", e)
+        return False
+    
+    if recovered.lower() != payment_data['from'].lower():
+        logger.error("❌ Подпись не от плательщика: recovered=%s, from=%s", recovered, payment_data['from'])
+        return False
+    return True
+
+# Запас до validBefore: авторизация должна пережить очередь и включение в блок,
+# иначе USDC transfer ревертнется уже после того, как мы приняли платеж
+VALID_BEFORE_MARGIN = 30
+
+def check_payment_terms(payment_data, require_price=True):
+    """
+    Проверки без RPC до любых tx: окно validAfter/validBefore с запасом VALID_BEFORE_MARGIN
+    (иначе USDC revert), а для минта - что платят нам и не меньше MINT_PRICE.
+    Возвращает текст ошибки или None.
+    """
+    try:
+        now = int(time.time())
+        if not int(payment_data['validAfter']) <= now < int(payment_data['validBefore']):
+            return "Authorization expired or not yet valid"
+        if int(payment_data['validBefore']) <= now + VALID_BEFORE_MARGIN:
+            return "Authorization expires too soon"
+        if require_price:
+            if RECIPIENT_BYTES and payment_data['toBytes'] != RECIPIENT_BYTES:
+                return "Wrong payment recipient"
+            if int(payment_data['value']) < MINT_PRICE:
+                return "Insufficient payment"
+    except (ValueError, TypeError):
+        return "Invalid payment fields"
+    return None
+
+def authorization_key(payment_data):
+    """
+    Ключ авторизации - как ее видит USDC: 20 байт from и 32 байта nonce.
+    Не строки: '0x'/без префикса и регистр hex - одна и та же авторизация
+    """
+    return payment_data['fromBytes'], payment_data['nonceBytes']
+
+def claim_authorization(payment_data):
+    """
+    Помечает авторизацию как используемую. False - если она уже в работе (replay).
+    Проверка и вставка идут без await между ними, поэтому в одном event loop атомарны.
+    """
+    key = authorization_key(payment_data)
+    if key in _seen_authorizations:
+        logger.warning("⚠️ Повторная авторизация: from=%s, nonce=%s", payment_data['from'], payment_data['nonce'])
+        return False
+    _seen_authorizations[key] = (int(payment_data['validBefore']), True)
+    return True
+
+def authorization_state(payment_data):
+    """
+    Дешевая проверка replay до ecrecover (сама отметка - в claim_authorization).
+    None - авторизация новая, True - в работе, (endpoint, body, status) - уже обработана:
+    повтор того же платежа получает прежний ответ вместо новых tx.
+    """
+    entry = _seen_authorizations.get(authorization_key(payment_data))
+    return entry[1] if entry else None
+
+def remember_result(payment_data, endpoint, body, status=200):
+    """Сохраняет ответ и его HTTP статус для идемпотентных повторов (тоже до validBefore)"""
+    _seen_authorizations[authorization_key(payment_data)] = (int(payment_data['validBefore']), (endpoint, body, status))
+
+def release_authorization(payment_data):
+    """Снимает отметку, если transfer так и не был отправлен (клиент может повторить)"""
+    _seen_authorizations.pop(authorization_key(payment_data), None)
+
+def build_usdc_transfer(payment_data):
+    """Собирает calldata USDC transferWithAuthorization из подписи пользователя"""
+    v, r, s = payment_data['vrs']
+    
+    return TRANSFER_WITH_AUTHORIZATION_SELECTOR + abi_encode(TRANSFER_WITH_AUTHORIZATION_TYPES, [
+        payment_data['fromBytes'],
+        payment_data['toBytes'],
+        int(payment_data['value']),
+        int(payment_data['validAfter']),
+        int(payment_data['validBefore']),
+        payment_data['nonceBytes'],
+        v,
+        r,
+        s
+    ])
+
+def build_mint(user_address, tx_hash_bytes):
+    """Собирает calldata mintNFT(to, txHash)"""
+    return MINT_NFT_SELECTOR + abi_encode(MINT_NFT_TYPES, [user_address, tx_hash_bytes])
+
+def build_admin_tx(to, data, nonce, gas, base_fee, max_prio, gas_multiplier=2):
+    """Собирает EIP-1559 tx от admin из TX_TEMPLATE напрямую, без build_transaction"""
+    return {
+        **TX_TEMPLATE,
+        'to': to,
+        'data': data,
+        'nonce': nonce,
+        'gas': gas,
+        'maxPriorityFeePerGas': max_prio,
+        'maxFeePerGas': base_fee * gas_multiplier + max_prio
+    }
+
+async def send_admin_tx(to, data, gas, label):
+    """
+    Подписывает и отправляет tx от admin на адрес to с calldata data, НЕ дожидаясь receipt.
+    RETRY логика - 3 попытки, maxFeePerGas растет с каждой попыткой.
+    Возвращает tx hash.
+    """
+    max_retries = 3
+    for attempt in range(max_retries):
+        nonce = None
+        try:
+            # Nonce из локального менеджера, fees - из кэша (параллельно, если кэш протух)
+            nonce, (base_fee, max_prio) = await asyncio.gather(
+                nonce_mgr.next(),
+                current_fees()
+            )
             
-            payment_data = decode_x402_payment(x_payment)
-            if not payment_data['valid']:
-                return jsonify({"error": "Invalid payment"}), 400
+            # Увеличиваем gas price с каждой попыткой
+            gas_multiplier = 2 + attempt  # 2x, 3x, 4x
             
-            # ABI для USDC transferWithAuthorization
-            usdc_abi = [
-                {
-                    "inputs": [
-                        {"name": "from", "type": "address"},
-                        {"name": "to", "type": "address"},
-                        {"name": "value", "type": "uint256"},
-                        {"name": "validAfter", "type": "uint256"},
-                        {"name": "validBefore", "type": "uint256"},
-                        {"name": "nonce", "type": "bytes32"},
-                        {"name": "v", "type": "uint8"},
-                        {"name": "r", "type": "bytes32"},
-                        {"name": "s", "type": "bytes32"}
-                    ],
-                    "name": "transferWithAuthorization",
-                    "outputs": [],
-                    "stateMutability": "nonpayable",
-                    "type": "function"
-                }
-            ]
+            logger.info("🔄 %s: попытка %s/%s, nonce=%s, gas_multiplier=%sx", label, attempt + 1, max_retries, nonce, gas_multiplier)
             
-            # Парсим подпись
-            signature = payment_data.get('signature')
-            if not signature:
-                log(f"❌ Отсутствует подпись в платеже")
-                return jsonify({"error": "Missing signature"}), 400
+            tx = build_admin_tx(to, data, nonce, gas, base_fee, max_prio, gas_multiplier)
             
-            if signature.startswith('0x'):
-                signature = signature[2:]
+            # Подписываем и отправляем
+            signed = ADMIN.sign_transaction(tx)
+            tx_hash = await w3.eth.send_raw_transaction(signed.raw_transaction)
             
-            sig_bytes = bytes.fromhex(signature)
-            r = sig_bytes[:32]  # bytes32
-            s = sig_bytes[32:64]  # bytes32
-            v = sig_bytes[64]
+            logger.info("💸 %s TX: %s", label, tx_hash.hex())
+            return tx_hash
+        
+        except Exception as tx_error:
+            error_msg = str(tx_error)
+            logger.warning("⚠️ %s: попытка %s провалилась: %s", label, attempt + 1, error_msg)
             
-            # Создаем контракт USDC
-            usdc_contract = w3.eth.contract(
-                address=Web3.to_checksum_address("0x833589fcd6edb6e08f4c7c32d4f71b54bda02913"),
-                abi=usdc_abi
-            )
+            nonce_error = 'nonce' in error_msg.lower() or 'replacement' in error_msg.lower()
             
-            # Получаем admin аккаунт
-            admin = w3.eth.account.from_key(ADMIN_PRIVATE_KEY)
+            # Сразу, без ожидания очереди минтов: задания за дырой в nonce не подтвердятся,
+            # пока ее не закрыть. Nonce error - счетчик разошелся с chain, пересинхронизируемся;
+            # иначе выданный nonce мог не дойти до chain - закрываем его пустым tx
+            if nonce_error:
+                nonce_mgr.reset()
+            elif nonce is not None:
+                await cancel_nonces((nonce,))
             
-            # RETRY логика - 3 попытки
-            max_retries = 3
-            for attempt in range(max_retries):
-                try:
-                    # Получаем PENDING nonce (учитывает ожидающие транзакции)
-                    nonce = w3.eth.get_transaction_count(admin.address, 'pending')
-                    
-                    # Получаем актуальную цену газа
-                    base_fee = w3.eth.gas_price
-                    
-                    # Увеличиваем gas price с каждой попыткой
-                    gas_multiplier = 2 + attempt  # 2x, 3x, 4x
-                    
-                    log(f"🔄 Попытка {attempt + 1}/{max_retries}, nonce={nonce}, gas_multiplier={gas_multiplier}x")
-                    
-                    # Создаем транзакцию
-                    usdc_tx = usdc_contract.functions.transferWithAuthorization(
-                        Web3.to_checksum_address(payment_data['from']),
-                        Web3.to_checksum_address(payment_data['to']),
-                        int(payment_data['value']),
-                        int(payment_data['validAfter']),
-                        int(payment_data['validBefore']),
-                        Web3.to_bytes(hexstr=payment_data['nonce']),
-                        v,
-                        r,
-                        s
-                    ).build_transaction({
-                        'from': admin.address,
-                        'nonce': nonce,
-                        'gas': 200000,  # Увеличили с 150k до 200k
-                        'maxFeePerGas': base_fee * gas_multiplier,
-                        'maxPriorityFeePerGas': w3.to_wei('0.01', 'gwei'),  # Увеличили с 0.001 до 0.01
-                        'chainId': 8453
-                    })
-                    
-                    # Подписываем и отправляем
-                    signed_usdc = admin.sign_transaction(usdc_tx)
-                    usdc_tx_hash = w3.eth.send_raw_transaction(signed_usdc.raw_transaction)
-                    
-                    log(f"💸 Facilitator: USDC transfer TX: {usdc_tx_hash.hex()}")
-                    
-                    # Ждем подтверждения
-                    receipt = w3.eth.wait_for_transaction_receipt(usdc_tx_hash, timeout=60)
-                    
-                    if receipt.status == 1:
-                        log(f"✅ Facilitator: USDC transfer успешен! Gas used: {receipt.gasUsed}")
-                        return jsonify({
-                            "success": True,
-                            "tx": usdc_tx_hash.hex(),
-                            "from": payment_data['from'],
-                            "to": payment_data['to'],
-                            "value": payment_data['value']
-                        })
-                    else:
-                        log(f"❌ Facilitator: USDC transfer провалился (status=0)")
-                        if attempt < max_retries - 1:
-                            log(f"⏳ Повторяем через 2 секунды...")
-                            time.sleep(2)
-                            continue
-                        else:
-                            return jsonify({"error": "Transfer failed after retries"}), 500
-                
-                except Exception as tx_error:
-                    error_msg = str(tx_error)
-                    log(f"⚠️ Попытка {attempt + 1} провалилась: {error_msg}")
-                    
-                    # Если это nonce error и есть ещё попытки - пробуем снова
-                    if 'nonce' in error_msg.lower() or 'replacement' in error_msg.lower():
-                        if attempt < max_retries - 1:
-                            log(f"⏳ Nonce conflict, повторяем через 3 секунды...")
-                            time.sleep(3)
-                            continue
-                    
-                    # Если последняя попытка - возвращаем ошибку
-                    if attempt >= max_retries - 1:
-                        raise tx_error
+            # Если последняя попытка - пробрасываем ошибку
+            if attempt >= max_retries - 1:
+                raise tx_error
             
-            return jsonify({"error": "All retries failed"}), 500
-                
+            # Если это nonce error - даем mempool время и пробуем снова
+            if nonce_error:
+                logger.info("⏳ Nonce conflict, повторяем через 3 секунды...")
+                await asyncio.sleep(3)
+
+# ═══════════════════════════════════════════════════════════
+# ОЧЕРЕДЬ ОТПРАВКИ МИНТОВ
+# ═══════════════════════════════════════════════════════════
+
+# /api/mint подписывает USDC transfer сам и отвечает сразу с id задания, а отправку
+# делает один воркер строго по порядку nonce. Минт подписывается позже, после receipt платежа.
+# Задание встает в очередь только со слотом mint_slots, так что больше MAX_PENDING_MINTS
+# в ней не бывает - давление на RPC ограничивает семафор, а не размер очереди
+mint_queue = asyncio.Queue(maxsize=MAX_PENDING_MINTS)
+mint_sender_task = None
+_settle_tasks = set()
+# Задания с подтвержденным платежом, ждущие минта (размер тоже ограничен mint_slots)
+paid_queue = asyncio.Queue()
+paid_sender_task = None
+
+async def broadcast_signed(signed, label):
+    """Отправляет подписанный tx; при сбое повторяет тот же raw tx (hash не меняется)"""
+    max_retries = 3
+    for attempt in range(max_retries):
+        try:
+            await w3.eth.send_raw_transaction(signed.raw_transaction)
+            logger.info("💸 %s TX: %s", label, signed.hash.hex())
+            return True
         except Exception as e:
-            log(f"❌ Facilitator error: {str(e)}")
-            log(f"📜 Traceback:\n{traceback.format_exc()}")
-            return jsonify({"error": str(e)}), 500
+            if 'already known' in str(e).lower():
+                # Прошлая попытка дошла до mempool
+                return True
+            logger.warning("⚠️ %s: отправка %s/%s провалилась: %s", label, attempt + 1, max_retries, e)
+            if attempt < max_retries - 1:
+                await asyncio.sleep(1)
+    return False
+
+async def cancel_nonces(nonces):
+    """
+    Закрывает nonce неотправленных (или застрявших) tx пустыми self-transfer, чтобы не было дыры.
+    Priority fee x2 - замена проходит и поверх уже висящего в mempool tx с тем же nonce.
+    Не бросает: при любом сбое (RPC лежит, fees не прочитать) - resync NonceManager с chain
+    """
+    try:
+        base_fee, max_prio = await current_fees()
+        for nonce in nonces:
+            tx = build_admin_tx(ADMIN.address, b'', nonce, 21000, base_fee, max_prio * 2, gas_multiplier=4)
+            if not await broadcast_signed(ADMIN.sign_transaction(tx), f"Cancel nonce {nonce}"):
+                raise RuntimeError(f"cancel tx для nonce {nonce} не отправлен")
+    except Exception as e:
+        logger.error("❌ Не удалось закрыть nonce %s (%s), сбрасываем NonceManager", list(nonces), e)
+        nonce_mgr.reset()
+
+async def broadcast_many(txs):
+    """
+    Отправляет несколько подписанных tx [(signed, label)] одним JSON-RPC batch через провайдер
+    напрямую (web3 batch_requests не пускает eth_sendRawTransaction). Ошибки - по элементам:
+    упавшие tx повторяем по одному. Возвращает список bool по каждому tx.
+    """
+    if len(txs) == 1:
+        return [await broadcast_signed(*txs[0])]
+    try:
+        responses = await w3.provider.make_batch_request([
+            ('eth_sendRawTransaction', [Web3.to_hex(signed.raw_transaction)]) for signed, _ in txs
+        ])
+        if not isinstance(responses, list):
+            raise ValueError(responses.get('error'))
+    except Exception as e:
+        logger.warning("⚠️ Batch из %s TX не прошел (%s), отправляем по одному", len(txs), e)
+        return [await broadcast_signed(signed, label) for signed, label in txs]
+    
+    # Ответы batch могут прийти в любом порядке - сопоставляем по id
+    responses = sorted(responses, key=lambda r: r['id'])
+    results = []
+    for (signed, label), response in zip(txs, responses):
+        error = response.get('error')
+        if error is None or 'already known' in str(error).lower():
+            logger.info("💸 %s TX: %s", label, signed.hash.hex())
+            results.append(True)
+        else:
+            logger.warning("⚠️ %s: %s в batch не прошел: %s", label, signed.hash.hex(), error)
+            results.append(await broadcast_signed(signed, label))
+    return results
+
+def finish_job(job, error):
+    """Итог отправки для reconcile_mint (None - минт отправлен) и task_done очереди - ровно один раз"""
+    if not job['sent'].done():
+        job['sent'].set_result(error)
+        mint_queue.task_done()
+
+async def confirm_payment(job):
+    """
+    Ждет receipt USDC transfer задания. None - платеж прошел (status == 1) и минт можно
+    отправлять; иначе текст ошибки
+    """
+    usdc_tx_hash = job['usdc'].hash
+    try:
+        receipt = await wait_for_receipt(usdc_tx_hash, timeout=60)
+    except Exception as e:
+        # Transfer мог выпасть из mempool - тогда его nonce стал дырой для всех следующих tx.
+        # Замещаем его пустым tx и ждем еще раз: в блок попадет либо платеж, либо замена
+        logger.warning("⚠️ Не дождались receipt USDC transfer %s: %s - закрываем nonce %s", usdc_tx_hash.hex(), e, job['nonce'])
+        await cancel_nonces((job['nonce'],))
+        try:
+            receipt = await wait_for_receipt(usdc_tx_hash, timeout=30)
+        except Exception:
+            logger.error("❌ USDC transfer %s так и не подтвердился - минт отменен", usdc_tx_hash.hex())
+            return "USDC transfer not confirmed"
+    
+    if receipt.status != 1:
+        logger.error("❌ USDC transfer провалился (status=0), минт задания %s отменен", job['id'])
+        # Revert не тратит nonce авторизации - клиент может повторить платеж
+        release_authorization(job['payment'])
+        return "USDC transfer failed"
+    
+    logger.info("✅ USDC transfer выполнен! TX: %s", usdc_tx_hash.hex())
+    return None
+
+async def settle_job(job):
+    """
+    Ведет задание после отправки платежа: ждет receipt USDC transfer и при status == 1
+    передает задание в paid_queue - минт подпишет и отправит paid_sender
+    """
+    try:
+        error = await confirm_payment(job)
+    except Exception as e:
+        logger.exception("❌ Ошибка задания минта %s: %s", job['id'], e)
+        error = str(e)
+    if error is None:
+        paid_queue.put_nowait(job)
+    else:
+        finish_job(job, error)
+
+async def paid_sender():
+    """
+    Воркер минтов: все задания, чей платеж подтвердился, пока шла прошлая отправка, уходят
+    одним JSON-RPC batch. Nonce минта берется здесь, а не при приеме запроса: иначе минт
+    держал бы за собой все следующие платежи (tx аккаунта идут строго по nonce)
+    """
+    while True:
+        jobs = [await paid_queue.get()]
+        while True:
+            try:
+                jobs.append(paid_queue.get_nowait())
+            except asyncio.QueueEmpty:
+                break
+        nonces = []
+        try:
+            base_fee, max_prio = await current_fees()
+            first_nonce = await nonce_mgr.next(len(jobs))
+            nonces = list(range(first_nonce, first_nonce + len(jobs)))
+            signed_mints = []
+            for job, nonce in zip(jobs, nonces):
+                signed = ADMIN.sign_transaction(build_admin_tx(
+                    NFT_CS, build_mint(job['to'], job['payment']['txHashBytes']), nonce, 250000, base_fee, max_prio
+                ))
+                job['mint'] = signed.hash
+                signed_mints.append((signed, "Mint"))
+            results = await broadcast_many(signed_mints)
+        except Exception as e:
+            logger.exception("❌ Ошибка отправки минтов: %s", e)
+            results = [False] * len(jobs)
+        
+        unsent = [nonce for nonce, ok in zip(nonces, results) if not ok]
+        try:
+            if unsent:
+                logger.error("❌ %s минт(ов) не отправлены, хотя USDC transfer подтвержден", len(unsent))
+                await cancel_nonces(unsent)
+        finally:
+            for job, ok in zip(jobs, results):
+                finish_job(job, None if ok else "Mint broadcast failed")
+                paid_queue.task_done()
+
+async def mint_sender():
+    """
+    Воркер очереди: USDC transfer всех накопившихся заданий уходит одним batch (по порядку nonce),
+    дальше каждое задание ведет settle_job. Минт уходит в mempool только после status == 1
+    у платежа: предпроверка eth_call не гарантия - плательщик может сорвать transfer уже после
+    нее (cancelAuthorization, перевод баланса). Размер batch ограничен размером очереди
+    """
+    while True:
+        jobs = [await mint_queue.get()]
+        while True:
+            try:
+                jobs.append(mint_queue.get_nowait())
+            except asyncio.QueueEmpty:
+                break
+        try:
+            results = await broadcast_many([(job['usdc'], "USDC transfer") for job in jobs])
+        except Exception as e:
+            logger.exception("❌ Ошибка воркера отправки: %s", e)
+            results = [False] * len(jobs)
+        
+        for job, ok in zip(jobs, results):
+            if ok:
+                # Ссылку на задачу держит _settle_tasks, итог - job['sent']
+                task = asyncio.create_task(settle_job(job))
+                _settle_tasks.add(task)
+                task.add_done_callback(_settle_tasks.discard)
+                continue
+            logger.error("❌ USDC transfer не отправлен - минт задания %s отменен", job['id'])
+            release_authorization(job['payment'])
+            try:
+                await cancel_nonces((job['nonce'],))
+            finally:
+                finish_job(job, "Broadcast failed")
+
+# ═══════════════════════════════════════════════════════════
+# RPC SESSION (keep-alive)
+# ═══════════════════════════════════════════════════════════
+
+# По умолчанию AsyncHTTPProvider закрывает соединение после каждого запроса
+# (force_close) - каждый RPC платит TCP+TLS handshake. Держим один пул на воркер
+rpc_session = None
+gas_task = None
+
+@app.before_serving
+async def open_rpc_session():
+    """Создает общий aiohttp session с keep-alive, запускает обновление fees и синхронизирует nonce"""
+    global rpc_session, gas_task, mint_sender_task, paid_sender_task
+    
+    # Здесь, а не в __main__: Procfile запускает hypercorn backend:app напрямую.
+    # eth_keys сам берет coincurve (C libsecp256k1), если он установлен - иначе чистый Python
+    from eth_keys.backends import get_backend
+    logger.info("🔑 secp256k1 backend: %s", type(get_backend()).__name__)
+    
+    rpc_session = aiohttp.ClientSession(
+        raise_for_status=True,
+        # ttl_dns_cache: RPC хостов - единицы, DNS резолвим раз в 5 минут, а не раз в 10с (дефолт)
+        connector=aiohttp.TCPConnector(limit=100, keepalive_timeout=75, ttl_dns_cache=300)
+    )
+    await w3.provider.cache_async_session(rpc_session)
+    gas_task = asyncio.create_task(gas_refresh_loop())
+    mint_sender_task = asyncio.create_task(mint_sender())
+    paid_sender_task = asyncio.create_task(paid_sender())
+    
+    if nonce_mgr:
+        try:
+            await nonce_mgr.warm_up()
+        except Exception as e:
+            # Не валим старт - next() синхронизируется при первом tx
+            logger.warning("⚠️ NonceManager: не удалось синхронизироваться при старте: %s", e)
+
+@app.after_serving
+async def close_rpc_session():
+    """Дожидается очереди минтов, останавливает фоновые задачи и закрывает общий aiohttp session"""
+    if mint_sender_task:
+        # Принятые задания должны дойти до минта до остановки. Первым делом: задание
+        # ждет receipt платежа перед минтом, так что poller нужен ему до конца очереди
+        await mint_queue.join()
+        mint_sender_task.cancel()
+        paid_sender_task.cancel()
+    if gas_task:
+        gas_task.cancel()
+    if receipt_poller_task:
+        receipt_poller_task.cancel()
+    if rpc_session:
+        await rpc_session.close()
+
+# ═══════════════════════════════════════════════════════════
+# API ENDPOINTS
+# ═══════════════════════════════════════════════════════════
+
+async def read_x_payment():
+    """x-payment из header, иначе из JSON body ({"payment": ...}) - без try/except на каждом запросе"""
+    x_payment = request.headers.get('x-payment')
+    if x_payment:
+        return x_payment
+    body = await request.get_json(silent=True)
+    return body.get('payment') if isinstance(body, dict) else None
+
+@app.route('/')
+async def index():
+    """Главная страница"""
+    return await render_template('index.html')
+
+@app.route('/api/facilitate', methods=['POST', 'OPTIONS'])
+async def facilitate():
+    """
+    Facilitator endpoint - выполняет USDC transfer используя подпись пользователя.
+    Без глобального lock: nonce выдает NonceManager, повтор авторизации - claim_authorization
+    """
+    if request.method == 'OPTIONS':
+        return '', 204
+    
+    claimed = False
+    usdc_tx_hash = None
+    # Тело читаем вне try: слишком большое отдает 413 от Quart, а не 500
+    x_payment = await read_x_payment()
+    
+    try:
+        if not x_payment:
+            return jsonify({"error": "Missing x-payment"}), 400
+        
+        logger.info("🔧 Facilitator: начинаем USDC transfer...")
+        
+        payment_data = decode_x402_payment(x_payment)
+        if not payment_data['valid']:
+            return jsonify({"error": "Invalid payment"}), 400
+        
+        if not payment_data.get('signature'):
+            logger.error("❌ Отсутствует подпись в платеже")
+            return jsonify({"error": "Missing signature"}), 400
+        
+        terms_error = check_payment_terms(payment_data, require_price=False)
+        if terms_error:
+            logger.error("❌ %s", terms_error)
+            return jsonify({"error": terms_error}), 400
+        
+        state = authorization_state(payment_data)
+        if state is True:
+            return jsonify({"error": "Payment already used"}), 409
+        
+        if not verify_payment_signature(payment_data):
+            return jsonify({"error": "Invalid signature"}), 400
+        
+        if state is not None:
+            # Подпись проверена - это повтор уже проведенного платежа
+            endpoint, body, status = state
+            if endpoint == 'facilitate':
+                return jsonify(body), status
+            return jsonify({"error": "Payment already used"}), 409
+        
+        if not claim_authorization(payment_data):
+            return jsonify({"error": "Payment already used"}), 409
+        claimed = True
+        
+        usdc_tx_hash = await send_admin_tx(
+            USDC_CS,
+            build_usdc_transfer(payment_data),
+            200000,  # Увеличили с 150k до 200k
+            "Facilitator USDC transfer"
+        )
+        
+        # Ждем подтверждения
+        receipt = await wait_for_receipt(usdc_tx_hash, timeout=60)
+        
+        if receipt.status == 1:
+            logger.info("✅ Facilitator: USDC transfer успешен! Gas used: %s", receipt.gasUsed)
+            body = {
+                "success": True,
+                "tx": usdc_tx_hash.hex(),
+                "from": payment_data['from'],
+                "to": payment_data['to'],
+                "value": payment_data['value']
+            }
+            remember_result(payment_data, 'facilitate', body)
+            return jsonify(body)
+        
+        logger.error("❌ Facilitator: USDC transfer провалился (status=0)")
+        # Revert не тратит nonce авторизации - клиент может повторить платеж (как и в минте)
+        release_authorization(payment_data)
+        return jsonify({"error": "Transfer failed"}), 500
+            
+    except Exception as e:
+        if claimed and usdc_tx_hash is None:
+            release_authorization(payment_data)
+        logger.exception("❌ Facilitator error: %s", e)
+        return jsonify({"error": str(e)}), 500
 
 @app.route('/api/mint', methods=['GET', 'POST', 'OPTIONS'])
-def mint():
+async def mint():
     """
     Endpoint для минта NFT
-    УЛУЧШЕННАЯ ВЕРСИЯ с Lock
+    USDC transfer подписывается здесь, отправляет его воркер очереди (mint_sender);
+    минт подписывается и уходит только после подтверждения платежа. Ответ 202 - сразу
+    с id задания, итог - через /api/mint/status/<job> (см. reconcile_mint)
     """
     if request.method == 'OPTIONS':
         return '', 204
     
+    # Получаем x-payment из headers или body (вне try: слишком большое тело - 413 от Quart)
+    x_payment = await read_x_payment()
+    
     try:
-        # Получаем x-payment из headers или body
-        x_payment = request.headers.get('x-payment')
-        if not x_payment and request.is_json:
-            try:
-                x_payment = request.json.get('payment')
-            except:
-                pass
-        
-        log(f"📝 Запрос минта для: {request.headers.get('x-forwarded-for', request.remote_addr)}")
+        logger.info("📝 Запрос минта для: %s", request.headers.get('x-forwarded-for', request.remote_addr))
         
         # Если нет x-payment - возвращаем 402
         if not x_payment:
-            response = jsonify({
-                "error": "Payment required to access this resource",
-                "x402Version": 1,
-                "facilitator": "https://stupidx402.onrender.com/api/facilitate",
-                "accepts": [{
-                    "scheme": "exact",
-                    "network": "base",
-                    "asset": "0x833589fCD6eDb6E08f4c7C32D4f71b54bdA02913",
-                    "maxAmountRequired": str(MINT_PRICE),
-                    "payTo": RECIPIENT_ADDRESS,
-                    "resource": "https://stupidx402.onrender.com/api/mint",
-                    "description": "Mint 1 STUPID402 NFT.",
-                    "mimeType": "application/json",
-                    "maxTimeoutSeconds": 300,
-                    "outputSchema": {
-                        "input": {
-                            "type": "http",
-                            "method": "GET",
-                            "discoverable": True
-                        },
-                        "output": {
-                            "type": "object",
-                            "properties": {
-                                "success": {"type": "boolean"},
-                                "tx": {"type": "string"},
-                                "to": {"type": "string"},
-                                "tokenId": {"type": "number"}
-                            }
-                        }
-                    },
-                    "extra": {
-                        "recipientAddress": RECIPIENT_ADDRESS,
-                        "name": "USD Coin",
-                        "version": "2",
-                        "primaryType": "TransferWithAuthorization",
-                        "projectName": "STUPID402",
-                        "projectDescription": "STUPID402 NFT Collection on Base",
-                        "website": "https://stupidx402.onrender.com",
-                        "icon": "https://stupidx402.onrender.com/static/icon.png"
-                    }
-                }]
-            })
-            response.status_code = 402
-            response.headers['Content-Type'] = 'application/json'
-            return response
+            return Response(_ACCEPTS_RESPONSE_BYTES, status=402, headers=_ACCEPTS_RESPONSE_HEADERS, mimetype='application/json')
         
         # Проверяем платеж
-        log("🔍 Проверяем x402 платеж...")
+        logger.info("🔍 Проверяем x402 платеж...")
         payment_data = decode_x402_payment(x_payment)
         
         if not payment_data['valid']:
@@ -389,153 +1175,224 @@ def mint():
                 "error": "Invalid payment"
             }), 400
         
-        log(f"✅ Платеж валиден! (x402 выполнит перевод USDC на контракт)")
-        log(f"✅ Платеж валиден! txHash: {payment_data['txHash']}")
+        terms_error = check_payment_terms(payment_data)
+        if terms_error:
+            # Платеж не под наши требования - 402, как и без x-payment
+            logger.error("❌ %s", terms_error)
+            return jsonify({
+                "x402Version": 1,
+                "error": terms_error
+            }), 402
         
-        # ВЫПОЛНЯЕМ USDC TRANSFER СРАЗУ
-        usdc_transfer_success = False
-        usdc_tx_hash = None
-        try:
-            log("💰 Вызываем facilitator для USDC transfer...")
-            import requests as req
-            facilitate_response = req.post(
-                "https://stupidx402.onrender.com/api/facilitate",
-                headers={"x-payment": x_payment},
-                json={"payment": x_payment},
-                timeout=90  # Увеличили таймаут с 60 до 90 сек
-            )
-            
-            if facilitate_response.status_code == 200:
-                result = facilitate_response.json()
-                usdc_tx_hash = result.get('tx')
-                log(f"✅ USDC transfer выполнен! TX: {usdc_tx_hash}")
-                usdc_transfer_success = True
-            else:
-                log(f"❌ USDC transfer failed: {facilitate_response.text}")
-        except Exception as e:
-            log(f"⚠️ Ошибка facilitator: {str(e)}")
+        state = authorization_state(payment_data)
+        if state is True:
+            return jsonify({
+                "x402Version": 1,
+                "error": "Payment already used"
+            }), 409
         
-        if not usdc_transfer_success:
-            log("❌ Останавливаем минт - USDC не списались")
+        if not verify_payment_signature(payment_data):
             return jsonify({
                 "x402Version": 1,
-                "error": "USDC transfer failed"
-            }), 500
-        
-        # Используем Lock для минта (предотвращает nonce conflicts при минте)
-        with mint_lock:
-            # Получаем текущий tokenId
-            nft_contract = w3.eth.contract(
-                address=Web3.to_checksum_address(NFT_CONTRACT),
-                abi=NFT_ABI
-            )
-            
-            current_token_id = nft_contract.functions.currentTokenId().call()
-            log(f"📊 Текущий tokenId: {current_token_id}")
+                "error": "Invalid payment signature"
+            }), 400
+        
+        if state is not None:
+            # Подпись проверена - повтор уже принятого минта: тот же ответ, без новых tx
+            return mint_replay_response(state)
+        
+        logger.info("✅ Платеж валиден! (x402 выполнит перевод USDC на контракт)")
+        logger.info("✅ Платеж валиден! txHash: %s", payment_data['txHash'])
+        
+        user_address = _checksum(payment_data['from'])
+        usdc_transfer_data = build_usdc_transfer(payment_data)
+        
+        # Слот берем до claim и до проверок: ожидание слота может длиться цикл подтверждения,
+        # и проверенное до него состояние (срок, баланс) к подписи уже устарело бы.
+        # Слот и claim принадлежат запросу, пока задание не в очереди: их снимает finally,
+        # в том числе при CancelledError (клиент отключился - Quart отменяет view),
+        # который except Exception не ловит. После put_nowait ими владеет reconcile_mint
+        await mint_slots.acquire()
+        claimed = enqueued = False
+        try:
+            if not claim_authorization(payment_data):
+                # Пока ждали слот, эту авторизацию занял параллельный запрос
+                return mint_replay_response(authorization_state(payment_data))
+            claimed = True
             
-            # Минтим NFT
-            user_address = Web3.to_checksum_address(payment_data['from'])
-            tx_hash_bytes = Web3.to_bytes(hexstr=payment_data['txHash'])
+            terms_error = check_payment_terms(payment_data)
+            if terms_error:
+                logger.error("❌ %s (после ожидания слота)", terms_error)
+                return jsonify({
+                    "x402Version": 1,
+                    "error": terms_error
+                }), 402
             
-            log(f"🎨 Минтим NFT с payment txHash: {payment_data['txHash']}...")
+            # Симулируем USDC transfer: невалидная авторизация (чужой nonce, нет баланса)
+            # отсекается до резервирования nonce и подписи.
+            # tokenId заранее не читаем - под конкуренцией он все равно устаревает,
+            # настоящий берется из Transfer-лога receipt (/api/mint/status/<job>)
+            try:
+                await w3.eth.call({'to': USDC_CS, 'data': usdc_transfer_data})
+            except Exception as e:
+                logger.error("❌ Предпроверка USDC transfer не прошла: %s", e)
+                return jsonify({
+                    "x402Version": 1,
+                    "error": "USDC transfer failed"
+                }), 500
             
-            admin_account = w3.eth.account.from_key(ADMIN_PRIVATE_KEY)
+            # Подписываем USDC transfer и отдаем воркеру очереди. Глобального lock нет:
+            # между next() и put_nowait нет await - порядок в очереди совпадает с порядком nonce,
+            # и отмена запроса не может прийтись на выданный, но не поставленный в очередь nonce
+            base_fee, max_prio = await current_fees()
+            usdc_nonce = await nonce_mgr.next()
             
-            # RETRY логика для минта
-            max_retries = 3
-            for attempt in range(max_retries):
-                try:
-                    # Получаем PENDING nonce
-                    nonce = w3.eth.get_transaction_count(admin_account.address, 'pending')
-                    base_fee = w3.eth.gas_price
-                    gas_multiplier = 2 + attempt
-                    
-                    mint_tx = nft_contract.functions.mintNFT(
-                        user_address,
-                        tx_hash_bytes
-                    ).build_transaction({
-                        'from': admin_account.address,
-                        'nonce': nonce,
-                        'gas': 250000,  # Увеличили с 200k до 250k
-                        'maxFeePerGas': base_fee * gas_multiplier,
-                        'maxPriorityFeePerGas': w3.to_wei('0.01', 'gwei'),
-                        'chainId': 8453
-                    })
-                    
-                    signed = admin_account.sign_transaction(mint_tx)
-                    mint_tx_hash = w3.eth.send_raw_transaction(signed.raw_transaction)
-                    
-                    log(f"⏳ Ждем подтверждения минта... TX: {mint_tx_hash.hex()}")
-                    
-                    receipt = w3.eth.wait_for_transaction_receipt(mint_tx_hash, timeout=90)
-                    
-                    if receipt.status == 1:
-                        log(f"✅ NFT #{current_token_id + 1} заминчен для {user_address}!")
-                        return jsonify({
-                            "success": True,
-                            "tx": mint_tx_hash.hex(),
-                            "to": user_address,
-                            "tokenId": current_token_id + 1,
-                            "x402Version": 1
-                        })
-                    else:
-                        if attempt < max_retries - 1:
-                            log(f"❌ Минт провалился, повторяем...")
-                            time.sleep(2)
-                            continue
-                        else:
-                            log(f"❌ Минт провалился после {max_retries} попыток")
-                            return jsonify({
-                                "x402Version": 1,
-                                "error": "Mint transaction failed"
-                            }), 500
-                
-                except Exception as mint_error:
-                    error_msg = str(mint_error)
-                    log(f"⚠️ Попытка минта {attempt + 1} провалилась: {error_msg}")
-                    
-                    if 'nonce' in error_msg.lower() or 'replacement' in error_msg.lower():
-                        if attempt < max_retries - 1:
-                            log(f"⏳ Nonce conflict при минте, повторяем...")
-                            time.sleep(3)
-                            continue
-                    
-                    if attempt >= max_retries - 1:
-                        raise mint_error
+            logger.info("💰 USDC transfer (nonce=%s) с payment txHash: %s", usdc_nonce, payment_data['txHash'])
+            signed_usdc = ADMIN.sign_transaction(
+                build_admin_tx(USDC_CS, usdc_transfer_data, usdc_nonce, 200000, base_fee, max_prio)
+            )
+            # Id задания - payment txHash: hash минта до подтверждения платежа неизвестен
+            job = {
+                'id': payment_data['txHash'],
+                'payment': payment_data,
+                'to': user_address,
+                'usdc': signed_usdc,
+                'nonce': usdc_nonce,
+                'mint': None,
+                'sent': asyncio.get_running_loop().create_future()
+            }
+            mint_queue.put_nowait(job)
             
-            return jsonify({
-                "x402Version": 1,
-                "error": "Mint failed after retries"
-            }), 500
+            # Receipt ждем в фоне: клиенту хватает id задания, статус - через /api/mint/status/<job>
+            task = asyncio.create_task(reconcile_mint(job))
+            # Слот освобождается, когда минт подтвердился или провалился
+            task.add_done_callback(lambda _: mint_slots.release())
+            enqueued = True
+            pending_mints[job['id']] = task
+        finally:
+            if not enqueued:
+                mint_slots.release()
+                if claimed:
+                    release_authorization(payment_data)
+        
+        body = {
+            "success": True,
+            "status": "submitted",
+            "job": job['id'],
+            "paymentTx": signed_usdc.hash.hex(),
+            "to": user_address,
+            "tokenId": "pending",
+            "x402Version": 1
+        }
+        remember_result(payment_data, 'mint', body, 202)
+        return jsonify(body), 202
             
     except Exception as e:
-        log(f"❌ Ошибка минта: {str(e)}")
-        log(f"📜 Traceback:\n{traceback.format_exc()}")
+        logger.exception("❌ Ошибка минта: %s", e)
         return jsonify({
             "x402Version": 1,
             "error": str(e)
         }), 500
 
-@app.route('/api/info', methods=['GET'])
-def info():
-    """Информация о проекте (с кэшем)"""
-    global info_cache
+def mint_replay_response(state):
+    """Ответ на уже занятую авторизацию: прежний ответ минта (тот же статус) или 409"""
+    if isinstance(state, tuple) and state[0] == 'mint':
+        endpoint, body, status = state
+        logger.info("♻️ Повтор минта %s - отдаем прежний ответ", body['job'])
+        return jsonify(body), status
+    return jsonify({
+        "x402Version": 1,
+        "error": "Payment already used"
+    }), 409
+
+def minted_token_id(receipt):
+    """tokenId из лога Transfer(0x0, to, tokenId) контракта NFT, None если лога нет"""
+    for log in receipt.get('logs', ()):
+        topics = log['topics']
+        if (len(topics) == 4 and topics[0] == TRANSFER_EVENT_TOPIC and topics[1] == ZERO_TOPIC
+                and log['address'].lower() == NFT_CONTRACT.lower()):
+            return int.from_bytes(topics[3], 'big')
+    return None
+
+async def reconcile_mint(job):
+    """
+    Итог минта для /api/mint/status. Он же заменяет закэшированный 202 "submitted":
+    повтор того же платежа получает настоящий результат (tokenId или ошибку), как и status
+    """
+    result = await confirm_mint(job)
+    # Авторизацию могли освободить (платеж не прошел) и занять заново - чужой ответ не трогаем
+    state = authorization_state(job['payment'])
+    if isinstance(state, tuple) and state[1].get('job') == job['id']:
+        if result["status"] == "confirmed":
+            remember_result(job['payment'], 'mint', {"success": True, "job": job['id'], "x402Version": 1, **result})
+        else:
+            remember_result(job['payment'], 'mint', {"job": job['id'], "x402Version": 1, **result}, 500)
+    return result
+
+async def confirm_mint(job):
+    """Фоново ждет, пока воркер проведет платеж и отправит минт, и receipt минта"""
+    error = await job['sent']
+    if error:
+        return {"status": "failed", "error": error}
     
-    # Проверяем кэш
-    now = time.time()
-    if info_cache["data"] and (now - info_cache["timestamp"]) < CACHE_TTL:
-        return jsonify(info_cache["data"])
+    mint_tx_hash = job['mint']
+    logger.info("⏳ Ждем подтверждения минта... TX: %s", mint_tx_hash.hex())
+    try:
+        mint_receipt = await wait_for_receipt(mint_tx_hash, timeout=90)
+    except Exception as e:
+        logger.error("❌ Не дождались receipt минта %s: %s", mint_tx_hash.hex(), e)
+        return {"status": "failed", "tx": mint_tx_hash.hex(), "error": str(e)}
+    
+    if mint_receipt.status != 1:
+        logger.error("❌ Минт провалился (status=0)")
+        return {"status": "failed", "tx": mint_tx_hash.hex(), "error": "Mint transaction failed"}
+    
+    token_id = minted_token_id(mint_receipt)
+    logger.info("✅ NFT #%s заминчен для %s!", token_id, job['to'])
+    
+    # /api/info: свой минт видно сразу, не дожидаясь истечения кэша.
+    # tokenId идут с 1 подряд, поэтому max() не задвоит уже учтенный минт
+    cached = info_cache["data"]
+    if cached and isinstance(token_id, int) and isinstance(cached["minted"], int):
+        cache_info({**cached, "minted": max(cached["minted"], token_id)})
+    return {"status": "confirmed", "tx": mint_tx_hash.hex(), "to": job['to'], "tokenId": token_id}
+
+@app.route('/api/mint/status/<job>', methods=['GET'])
+async def mint_status(job):
+    """Итог минта по id задания (из ответа /api/mint): ждет фоновую задачу, если она еще идет"""
+    task = pending_mints.get(job.lower().removeprefix('0x'))
+    if task is None:
+        return jsonify({"error": "Unknown mint job"}), 404
+    
+    # shield: отключившийся клиент не должен отменять саму задачу
+    result = await asyncio.shield(task)
+    if result["status"] != "confirmed":
+        return jsonify({"job": job, "x402Version": 1, **result}), 500
+    return jsonify({"success": True, "job": job, "x402Version": 1, **result})
+
+async def refresh_info():
+    """Читает supply из chain и обновляет info_cache"""
+    global max_supply_cache
     
-    # Обновляем кэш
+    now = time.time()
     try:
-        nft_contract = w3.eth.contract(
-            address=Web3.to_checksum_address(NFT_CONTRACT), 
-            abi=NFT_ABI
-        )
-        total_supply = nft_contract.functions.totalSupply().call()
-        max_supply = nft_contract.functions.MAX_SUPPLY().call()
+        if max_supply_cache is None:
+            # Оба чтения одним eth_call через Multicall3 (не зависит от поддержки batch у RPC)
+            raw = await w3.eth.call({'to': MULTICALL3_ADDRESS, 'data': INFO_MULTICALL_DATA})
+            (results,) = abi_decode(['(bool,bytes)[]'], raw)
+            total_supply, max_supply = (abi_decode(['uint256'], data)[0] for _, data in results)
+            max_supply_cache = max_supply
+        else:
+            # MAX_SUPPLY - константа контракта, читаем только totalSupply
+            raw = await w3.eth.call({'to': NFT_CS, 'data': TOTAL_SUPPLY_DATA})
+            total_supply = abi_decode(['uint256'], raw)[0]
+            max_supply = max_supply_cache
     except Exception as e:
-        log(f"⚠️ Error reading contract: {e}")
+        logger.warning("⚠️ Error reading contract: %s", e)
+        if info_cache["data"]:
+            # RPC недоступен - оставляем прежние данные, следующая попытка через CACHE_TTL
+            info_cache["timestamp"] = now
+            return
         total_supply = "unknown"
         max_supply = 1000
     
@@ -549,31 +1406,80 @@ def info():
     }
     
     # Сохраняем в кэш
-    info_cache["data"] = data
+    cache_info(data)
     info_cache["timestamp"] = now
+
+def cache_info(data):
+    """Кладет данные /api/info в кэш вместе с готовым JSON и ETag (сериализуем один раз на обновление)"""
+    body = orjson.dumps(data)
+    info_cache["data"] = data
+    info_cache["body"] = body
+    info_cache["etag"] = hashlib.blake2b(body, digest_size=16).hexdigest()
+
+@app.route('/api/info', methods=['GET'])
+async def info():
+    """Информация о проекте (с кэшем, stale-while-revalidate)"""
+    global info_refresh_task
     
-    return jsonify(data)
+    # Протухший кэш обновляем в фоне и сразу отдаем старые данные,
+    # ждет RPC только самый первый запрос. Одно обновление на всех
+    if time.time() - info_cache["timestamp"] >= CACHE_TTL and (info_refresh_task is None or info_refresh_task.done()):
+        info_refresh_task = asyncio.create_task(refresh_info())
+    
+    if info_cache["data"] is None:
+        # shield: отключившийся клиент не отменяет общее обновление
+        await asyncio.shield(info_refresh_task)
+    
+    # Фронтенд опрашивает /api/info постоянно: без изменений отвечаем 304 без тела
+    etag = info_cache["etag"]
+    if request.if_none_match.contains_weak(etag):
+        response = Response(status=304)
+    else:
+        response = Response(info_cache["body"], mimetype='application/json')
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = f'public, max-age={CACHE_TTL}'
+    return response
 
 @app.route('/health', methods=['GET'])
-def health():
+async def health():
     """Health check"""
     return jsonify({"status": "ok"})
 
 # CORS для всех endpoints
+# CORS заголовки одинаковые для всех ответов - собираем один раз
+_CORS_HEADERS = (
+    ('Access-Control-Allow-Origin', '*'),
+    ('Access-Control-Allow-Headers', 'Content-Type,x-payment'),
+    ('Access-Control-Allow-Methods', 'GET,POST,OPTIONS'),
+)
+
 @app.after_request
 def after_request(response):
-    response.headers.add('Access-Control-Allow-Origin', '*')
-    response.headers.add('Access-Control-Allow-Headers', 'Content-Type,x-payment')
-    response.headers.add('Access-Control-Allow-Methods', 'GET,POST,OPTIONS')
+    for name, value in _CORS_HEADERS:
+        response.headers[name] = value
     return response
 
 if __name__ == '__main__':
-    log("🚀 Запускаем NFT Mint API v2 (УЛУЧШЕННАЯ ВЕРСИЯ) на порту 5000...")
-    log(f"📝 NFT Contract: {NFT_CONTRACT}")
-    log(f"💰 Mint Price: {MINT_PRICE / 1000000} USDC")
-    log(f"📬 Recipient: {RECIPIENT_ADDRESS}")
-    log(f"🔒 Защита: Lock + Pending Nonce + Retry логика")
+    # Hypercorn вместо встроенного dev сервера
+    from hypercorn.asyncio import serve
+    from hypercorn.config import Config
     
     port = int(os.getenv("PORT", 5000))
-    app.run(host='0.0.0.0', port=port, debug=False)
+    
+    logger.info("🚀 Запускаем NFT Mint API v3 (ASGI, hypercorn) на порту %s...", port)
+    logger.info("📝 NFT Contract: %s", NFT_CONTRACT)
+    logger.info("💰 Mint Price: %s USDC", MINT_PRICE / 1000000)
+    logger.info("📬 Recipient: %s", RECIPIENT_ADDRESS)
+    logger.info("🔒 Защита: NonceManager (next(2) на пару) + очередь отправки + Retry логика")
+    
+    config = Config()
+    config.bind = [f"0.0.0.0:{port}"]
+    config.keep_alive_timeout = 75
+    
+    # uvloop - быстрее стандартного event loop (на Windows его нет)
+    try:
+        import uvloop
+        uvloop.run(serve(app, config))
+    except ImportError:
+        asyncio.run(serve(app, config))
 